@@ -0,0 +1,124 @@
+"""
+per-column encoders turning extracted mssql values into delimited text
+"""
+
+import itertools
+
+# characters that would break a delimited row, each is replaced with a space
+ESCAPED_CHARS = ('\n', '\t', '\r', '\v')
+
+# mssql types whose str() can never contain an escaped character
+PLAIN_TYPES = ('tinyint', 'smallint', 'int', 'bigint', 'decimal', 'numeric', 'money', 'smallmoney',
+               'float', 'real', 'date', 'time', 'datetime', 'datetime2', 'smalldatetime',
+               'uniqueidentifier')
+BIT_TYPES = ('bit',)
+STRING_TYPES = ('char', 'varchar', 'nchar', 'nvarchar', 'text', 'ntext', 'xml', 'sysname')
+
+# joins a whole string column so it can be escaped in one pass, must not occur in the data
+_SEPARATOR = '\x00'
+_BITS = {True: '1', False: '0', None: 'None'}
+
+
+def escape_value(value):
+    """
+    Encodes a single value of unknown type, the way rows were always staged
+
+    :param value:
+    :return: str
+    """
+    if isinstance(value, bool):
+        return str(int(value))
+    return str(value).replace('\n', ' ').replace('\t', ' ').replace('\r', ' ').replace('\v', ' ')
+
+
+def encode_generic(column):
+    """
+    :param column: tuple of values
+    :return: list of str
+    """
+    return [escape_value(v) for v in column]
+
+
+def encode_plain(column):
+    """
+    Numerics and dates need no escaping; datetime's str() is its fixed iso format
+
+    :param column: tuple of values
+    :return: list of str
+    """
+    return list(map(str, column))
+
+
+def encode_bit(column):
+    """
+    :param column: tuple of bools
+    :return: list of str
+    """
+    try:
+        return list(map(_BITS.__getitem__, column))
+    except KeyError:
+        return encode_generic(column)
+
+
+def encode_string(column):
+    """
+    Escapes a whole column at once: the values are joined, replaced in a single
+    pass over the joined text, and split again
+
+    :param column: tuple of values
+    :return: list of str
+    """
+    text = _SEPARATOR.join(map(str, column))
+    if text.count(_SEPARATOR) != len(column) - 1:
+        return encode_generic(column)
+    for char in ESCAPED_CHARS:
+        text = text.replace(char, ' ')
+    return text.split(_SEPARATOR)
+
+
+def column_encoder(data_type):
+    """
+    :param data_type: str, information_schema data type of the source column
+    :return: function encoding a column of values into a list of str
+    """
+    data_type = str(data_type).lower()
+    if data_type in PLAIN_TYPES:
+        return encode_plain
+    if data_type in BIT_TYPES:
+        return encode_bit
+    if data_type in STRING_TYPES:
+        return encode_string
+    return encode_generic
+
+
+class RowEncoder(object):
+    """
+    Encodes batches of source rows, compiled once per table from the source schema
+    into one encoder per column plus the precomputed metadata suffix
+    """
+    def __init__(self, schema, meta_values, delimiter='\t'):
+        """
+        :param schema: list of (column_name, data_type, ...) as returned for the selected fields
+        :param meta_values: list of metadata values appended to every row
+        :param delimiter:
+        """
+        self.encoders = [column_encoder(field[1]) for field in schema]
+        self.meta_values = [escape_value(v) for v in meta_values]
+        # when the delimiter is itself escaped, no encoded value can contain it and
+        # rows can be joined directly instead of going through csv
+        self.joinable = delimiter in ESCAPED_CHARS
+
+    def encode(self, rows):
+        """
+        :param rows: list of source rows
+        :return: list of tuples of str
+        """
+        if not rows:
+            return []
+        columns = list(zip(*rows))
+        encoders = self.encoders
+        if len(columns) != len(encoders):
+            encoders = [encode_generic] * len(columns)
+        encoded = [encoder(column) for encoder, column in zip(encoders, columns)]
+        encoded.extend(itertools.repeat(v, len(rows)) for v in self.meta_values)
+        return list(zip(*encoded))
@@ -3,12 +3,12 @@
 module for performing simple extract-load operations from mssql to redshift
 """
 
-import csv
+import math
 import os
-import gzip as gz
 import json
 import argparse
 import time
+from itertools import islice
 from time import sleep
 from datetime import datetime
 from dateutil import parser
@@ -18,6 +18,9 @@ from codb.mssql_tools import MSSQLInteraction
 from codb.pg_tools import PGInteraction
 from cocloud.s3_interaction import S3Interaction
 
+from rsqoop_runner.encoders import RowEncoder
+from rsqoop_runner.staging import PartFileWriter, S3PartWriter
+
 LOG = Logger()
 
 
@@ -25,6 +28,9 @@ class rSqoop(object):
     """
     Redshift-Sqoop: quick staging of tables from MSSQL to Redshift
     """
+    # smallest part worth splitting an extract into when sizing parts by slice count
+    min_part_rows = 10000
+
     def __init__(self, src_database=None, tgt_database=None, from_date=None):
         self.src_database = src_database
         self.tgt_database = tgt_database
@@ -162,12 +168,14 @@ class rSqoop(object):
             field_names.append(field[0])
         return ','.join(field_names)
 
-    def clone_staging_table(self, src_table, tgt_table, select_fields=None, incremental=False):
+    def clone_staging_table(self, src_table, tgt_table, select_fields=None, incremental=False,
+                            src_schema=None):
         """
         Clones src table schema to redshift
 
         :param src_table:
         :param tgt_table:
+        :param src_schema: result of get_source_table_schema, fetched when not given
         :return:
         """
         rs_date_types = ('timestamp with time zone', 'time without time zone',
@@ -184,7 +192,8 @@ class rSqoop(object):
                           'timestamp without time zone')
         rs_reserved_names = ('partition',)
 
-        src_schema = self.get_source_table_schema(src_table)
+        if src_schema is None:
+            src_schema = self.get_source_table_schema(src_table)
         schema = self.get_fields(select_fields, src_schema)
 
         tgt_exists = self.pg_conn.table_exists(tgt_table)
@@ -286,7 +295,13 @@ class rSqoop(object):
                      date_fields=None,
                      delimiter='\t',
                      gzip=True,
-                     source_system_cd=None):
+                     source_system_cd=None,
+                     split_files=False,
+                     part_rows=None,
+                     part_bytes=None,
+                     stream=False,
+                     upload_threads=4,
+                     src_schema=None):
         """
         Transfers data from source table to s3
 
@@ -297,6 +312,13 @@ class rSqoop(object):
         :param date_fields:
         :param delimiter:
         :param gzip:
+        :param split_files: True to write rolling part files and return a COPY manifest url
+        :param part_rows: max rows per part file (split_files only)
+        :param part_bytes: max bytes per part file, compressed if gzip (split_files only)
+        :param stream: True to upload as s3 multipart while extracting instead of via temp/
+        :param upload_threads: concurrent part uploads per file when streaming
+        :param src_schema: result of get_source_table_schema, fetched when not given
+        :return: s3 url of the single output file, or of the manifest when split_files
         """
 
         tgt_key = tgt_table.replace('.', '-')
@@ -313,20 +335,31 @@ class rSqoop(object):
             date_str = [date + f" > '{self.from_date.strftime('%Y-%m-%d %H:%M')}'" for date in date_fields]
             filter_str = f"where {' or '.join(date_str)}"
 
+        if src_schema is None:
+            src_schema = self.get_source_table_schema(src_table)
+
         # for custom field selection
         select_str = '*'
         if select_fields:
-            src_schema = self.get_source_table_schema(src_table)
             select_str = self.get_select_fields(src_schema, select_fields)
 
         ce_sql = f"select {select_str} from {src_table} with (nolock) {filter_str}"
         LOG.l(ce_sql)
 
-        result = self.sql.fetch_sql(sql=ce_sql, blocksize=20000)
+        blocksize = 20000
+        result = iter(self.sql.fetch_sql(sql=ce_sql, blocksize=blocksize))
 
-        temp_file = gz.open('temp/%s.txt' % tgt_key, mode='wt', encoding='utf-8') if gzip \
-            else open('temp/%s.txt' % tgt_key, mode='w', encoding='utf-8')
-        LOG.l('exporting to tempfile:' + temp_file.name)
+        if not split_files:
+            part_rows, part_bytes = None, None
+        if stream:
+            part_writer = S3PartWriter(self.s3_conn.client, s3_bucket, s3_key, delimiter=delimiter,
+                                       gzip=gzip, part_rows=part_rows, part_bytes=part_bytes,
+                                       upload_concurrency=upload_threads)
+            LOG.l('streaming to ' + s3_path)
+        else:
+            part_writer = PartFileWriter('temp/%s' % tgt_key, delimiter=delimiter, gzip=gzip,
+                                         part_rows=part_rows, part_bytes=part_bytes)
+            LOG.l('exporting to tempfiles:' + part_writer.path_prefix)
 
         self.meta_fields['etl_row_create_dts'] = self.etl_date.strftime('%Y-%m-%d %H:%M:%S')
         self.meta_fields['etl_row_update_dts'] = self.meta_fields['etl_row_create_dts']
@@ -334,20 +367,22 @@ class rSqoop(object):
         # check if there is source_system_cd user input
         self.meta_fields['etl_source_system_cd'] = source_system_cd if source_system_cd else ''
         meta_values = list(self.meta_fields.values())
+        encoder = RowEncoder(self.get_fields(select_fields, src_schema), meta_values, delimiter)
+        part_writer.joined = encoder.joinable
 
-        writer = csv.writer(temp_file, delimiter=delimiter, quoting=csv.QUOTE_NONE, quotechar="")
-        for row in result:
-            row_data = []
-            for s in row:
-                if isinstance(s, bool):
-                    s = int(s)
-                else:
-                    s = str(s).replace('\n', ' ').replace('\t', ' ').replace('\r', ' ').replace('\v', ' ')
-                row_data.append(s)
-            writer.writerow(row_data + meta_values)
-        temp_file.flush()
-        temp_file.close()
-        sleep(10)
+        try:
+            rows = list(islice(result, blocksize))
+            while rows:
+                part_writer.writerows(encoder.encode(rows))
+                rows = list(islice(result, blocksize))
+            parts = part_writer.close()
+        except Exception:
+            part_writer.abort()
+            raise
+        LOG.l(f'exported {part_writer.rows_written} rows to {len(parts)} file(s)')
+
+        if not stream:
+            sleep(10)
 
         # simple quick keep alive for large tables
         self.pg_conn.conn()
@@ -355,15 +390,27 @@ class rSqoop(object):
         self.pg_conn.fetch_sql("select 1")
         self.sql.fetch_sql("select 1")
 
-        LOG.l('upload starting')
-        self.s3_conn.put_file_to_s3(bucket=s3_bucket, key=s3_key + '/output.tsv',
-                               local_filename=temp_file.name)
-
-        s3_full_path = s3_path + '/' + 'output.tsv'
+        if stream:
+            keys = parts
+        else:
+            LOG.l('upload starting')
+            if split_files:
+                keys = [s3_key + f'/part-{i:05d}.tsv' for i in range(len(parts))]
+            else:
+                keys = [s3_key + '/output.tsv']
+            for key, local_file in zip(keys, parts):
+                self.s3_conn.put_file_to_s3(bucket=s3_bucket, key=key, local_filename=local_file)
+            for local_file in parts:
+                if os.path.exists(local_file):
+                    os.remove(local_file)
         LOG.l('upload complete to ' + s3_path)
 
-        if os.path.exists(temp_file.name):
-            os.remove(temp_file.name)
+        if split_files:
+            urls = ['s3://' + s3_bucket + '/' + key for key in keys]
+            s3_full_path, _ = self.build_rs_manifest(urls, mfst_bucket=s3_bucket, mfst_key_prefix=s3_key,
+                                                     mfst_filename='output.manifest')
+        else:
+            s3_full_path = s3_path + '/' + 'output.tsv'
 
         return s3_full_path
 
@@ -506,6 +553,28 @@ class rSqoop(object):
         LOG.l(f'src_cnt: {src_cnt}')
         return src_cnt
 
+    def get_slice_count(self):
+        """
+        Number of slices in the target redshift cluster, used to size part files
+
+        :return: int
+        """
+        return self.pg_conn.fetch_sql_all("select count(1) from stv_slices")[0][0]
+
+    def get_part_rows(self, src_cnt, files_per_slice=1):
+        """
+        Rows per part file so that an extract of src_cnt rows splits into a multiple
+        of the cluster's slice count
+
+        :param src_cnt: expected row count
+        :param files_per_slice:
+        :return: int
+        """
+        parts = max(self.get_slice_count(), 1) * files_per_slice
+        part_rows = int(math.ceil(src_cnt / parts))
+        LOG.l(f'splitting into {parts} parts of up to {part_rows} rows')
+        return max(part_rows, self.min_part_rows)
+
     def check_tgt_count(self, src_cnt, tgt_table, pct_threshold=0.01):
         """
         Basic source to target data quality checks
@@ -549,8 +618,6 @@ class rSqoop(object):
         mfst_filename = mfst_filename if mfst_filename \
             else datetime.now().strftime("%Y%m%d-%H%M%S%f")
 
-        s3_bucket = self.s3_environment.get_bucket(mfst_bucket)
-
         LOG.l(mfst_filename)
         entries = []
         for url in url_list:
@@ -561,7 +628,7 @@ class rSqoop(object):
         mfst_key_name = mfst_key_prefix + '/' + mfst_filename
         mfst = {"entries":entries}
         mfst_str = str(json.dumps(mfst))
-        s3_bucket.new_key(mfst_key_name).set_contents_from_string(mfst_str)
+        self.s3_conn.put_file_to_s3_from_string(mfst_bucket, mfst_key_name, mfst_str)
         mfst_url = f"s3://{mfst_bucket}/{mfst_key_name}"
         return mfst_url, mfst
 
@@ -589,7 +656,12 @@ class rSqoop(object):
                           remove_quotes=False,
                           key_fields=None,
                           select_fields=None,
-                          source_system_cd=None):
+                          source_system_cd=None,
+                          split_files=False,
+                          part_rows=None,
+                          part_bytes=None,
+                          stream=False,
+                          upload_threads=4):
         """
         Clones table from source, stages to s3, and then copies into redshift
 
@@ -603,12 +675,20 @@ class rSqoop(object):
         :param key_fields:
         :param select_fields:
         :param source_system_cd:
+        :param split_files: True to stage as parallel-loadable part files with a manifest
+        :param part_rows: max rows per part file, default sizes parts by cluster slice count
+        :param part_bytes: max compressed bytes per part file
+        :param stream: True to stream the extract to s3 without a local temp file
+        :param upload_threads: concurrent multipart uploads when streaming
         :return:
         """
         LOG.l(f'\n\n--starting staging of {src_table}')
 
+        src_schema = self.get_source_table_schema(src_table)
+
         # 1. clone tables (if doesn't already exist)
-        src_name, tgt_name = self.clone_staging_table(src_table, tgt_table, select_fields, incremental=incremental)
+        src_name, tgt_name = self.clone_staging_table(src_table, tgt_table, select_fields, incremental=incremental,
+                                                      src_schema=src_schema)
 
         LOG.l(f'loading to {tgt_name}')
 
@@ -619,15 +699,21 @@ class rSqoop(object):
         src_cnt = self.get_src_count(src_table)
 
         # 3. copy data to s3
+        if split_files and not part_rows and not part_bytes:
+            part_rows = self.get_part_rows(src_cnt)
         s3_path = self.source_to_s3(src_table, tgt_table,
                                     select_fields=select_fields,
                                     date_fields=date_fields, delimiter=delimiter,
-                                    gzip=gzip, source_system_cd=source_system_cd)
+                                    gzip=gzip, source_system_cd=source_system_cd,
+                                    split_files=split_files, part_rows=part_rows,
+                                    part_bytes=part_bytes, stream=stream,
+                                    upload_threads=upload_threads, src_schema=src_schema)
 
         # 4. copy s3 data to redshift
         self.s3_to_redshift(tgt_table=tgt_table,
                             s3_path=s3_path,
                             gzip=gzip,
+                            manifest=split_files,
                             delimiter=delimiter,
                             remove_quotes=remove_quotes,
                             key_fields=key_fields,
@@ -653,6 +739,11 @@ if __name__ == '__main__':
     aparser.add_argument('-df', '--date-fields', nargs='*', help='date fields for incremental (list)', required=False)
     aparser.add_argument('-f', '--from-date', type=parser.parse, help='from date for incremental', required=False)
     aparser.add_argument('-ss', '--source-system', help='source system cd', required=False)
+    aparser.add_argument('-sp', '--split-files', default=False, action='store_true', help='True to stage parallel-loadable part files', required=False)
+    aparser.add_argument('-pr', '--part-rows', type=int, help='max rows per part file, default sized by slice count', required=False)
+    aparser.add_argument('-pb', '--part-bytes', type=int, help='max compressed bytes per part file', required=False)
+    aparser.add_argument('-sm', '--stream', default=False, action='store_true', help='True to stream to s3 without a temp file', required=False)
+    aparser.add_argument('-ut', '--upload-threads', type=int, default=4, help='concurrent multipart uploads when streaming', required=False)
     args = aparser.parse_args()
 
     r = rSqoop(args.source_conn, args.target_conn, args.from_date).init()
@@ -670,5 +761,10 @@ if __name__ == '__main__':
             remove_quotes=args.remove_quotes,
             select_fields=args.select_fields,
             key_fields=args.key_fields,
-            source_system_cd=args.source_system
+            source_system_cd=args.source_system,
+            split_files=args.split_files,
+            part_rows=args.part_rows,
+            part_bytes=args.part_bytes,
+            stream=args.stream,
+            upload_threads=args.upload_threads
         )
@@ -0,0 +1,288 @@
+"""
+writers for staging extracted rows as delimited part files
+"""
+
+import csv
+import gzip as gz
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PartFileWriter(object):
+    """
+    Writes delimited rows into a rolling series of part files. A new part is started
+    whenever the current one reaches part_rows rows or part_bytes bytes on disk
+    (compressed size when gzip is on), so the extract can be loaded in parallel.
+    """
+    # csv's default line terminator, kept for rows that bypass csv
+    lineterminator = '\r\n'
+
+    def __init__(self, path_prefix, delimiter='\t', gzip=True, part_rows=None, part_bytes=None,
+                 joined=False):
+        """
+        :param path_prefix:
+        :param delimiter:
+        :param gzip:
+        :param part_rows:
+        :param part_bytes:
+        :param joined: True when rows are str values that can never contain the delimiter
+            or a line break, so writerows joins them directly instead of using csv
+        """
+        self.path_prefix = path_prefix
+        self.delimiter = delimiter
+        self.gzip = gzip
+        self.part_rows = part_rows
+        self.part_bytes = part_bytes
+        self.joined = joined
+
+        self.parts = []
+        self.rows_written = 0
+        self.part_row_count = 0
+
+        self._raw = None
+        self._text = None
+        self._writer = None
+
+    def part_name(self, index):
+        """
+        :param index: int, zero based part number
+        :return: str, local filename of the part
+        """
+        return f'{self.path_prefix}.{index:05d}.txt'
+
+    def _open_sink(self, name):
+        return open(name, mode='wb')
+
+    def _open_part(self):
+        name = self.part_name(len(self.parts))
+        self._raw = self._open_sink(name)
+        stream = gz.GzipFile(fileobj=self._raw, mode='wb') if self.gzip else self._raw
+        self._text = io.TextIOWrapper(stream, encoding='utf-8')
+        self._writer = csv.writer(self._text, delimiter=self.delimiter, quoting=csv.QUOTE_NONE,
+                                  quotechar=None)
+        self.parts.append(name)
+        self.part_row_count = 0
+
+    def _close_part(self):
+        if self._text is None:
+            return
+        self._text.close()
+        if not self._raw.closed:
+            self._raw.close()
+        self._raw = None
+        self._text = None
+        self._writer = None
+
+    def _part_full(self):
+        if self.part_rows and self.part_row_count >= self.part_rows:
+            return True
+        return bool(self.part_bytes) and self._raw.tell() >= self.part_bytes
+
+    def _ensure_part(self):
+        if self._writer is None:
+            self._open_part()
+        elif self.part_row_count and self._part_full():
+            self._close_part()
+            self._open_part()
+
+    def writerow(self, row):
+        """
+        :param row: list of encoded values
+        """
+        self._ensure_part()
+        self._writer.writerow(row)
+        self.part_row_count += 1
+        self.rows_written += 1
+
+    def writerows(self, rows):
+        """
+        Writes a batch of rows, splitting it across parts where part_rows requires
+
+        :param rows: list of lists of encoded values
+        """
+        start = 0
+        while start < len(rows):
+            self._ensure_part()
+            end = len(rows)
+            if self.part_rows:
+                end = min(end, start + self.part_rows - self.part_row_count)
+            if self.joined:
+                self._text.write(self.lineterminator.join(map(self.delimiter.join, rows[start:end]))
+                                 + self.lineterminator)
+            else:
+                self._writer.writerows(rows[start:end])
+            self.part_row_count += end - start
+            self.rows_written += end - start
+            start = end
+
+    def close(self):
+        """
+        Closes the current part; an empty extract still produces one (empty) part
+
+        :return: list of local part filenames
+        """
+        if not self.parts:
+            self._open_part()
+        self._close_part()
+        return self.parts
+
+    def _abort_sink(self, sink):
+        sink.close()
+
+    def _discard_part(self):
+        if self._raw is not None:
+            self._abort_sink(self._raw)
+        if self._text is not None:
+            # the sink is already closed, so flushing the wrappers can only fail
+            try:
+                self._text.close()
+            except (ValueError, OSError):
+                pass
+        self._raw = None
+        self._text = None
+        self._writer = None
+
+    def abort(self):
+        """
+        Discards everything written so far after a failed extract
+        """
+        self._discard_part()
+        for name in self.parts:
+            if os.path.exists(name):
+                os.remove(name)
+
+
+class S3MultipartFile(io.BufferedIOBase):
+    """
+    Write-only file object that streams into an s3 key as a multipart upload.
+    Writes are buffered into parts of part_size bytes which are uploaded on a
+    thread pool; at most max_pending parts are held in memory at once, after
+    which writes block until the oldest upload finishes.
+    """
+    # s3 rejects multipart parts smaller than 5MB (other than the last one)
+    min_part_size = 5 * 1024 * 1024
+
+    def __init__(self, s3_client, bucket, key, part_size=16 * 1024 * 1024, concurrency=4, max_pending=None):
+        super().__init__()
+        self.client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.name = key
+        self.part_size = max(part_size, self.min_part_size)
+        self.max_pending = max_pending if max_pending else concurrency
+        self.upload_id = None
+        self.bytes_written = 0
+
+        self._buffer = bytearray()
+        self._pending = []
+        self._parts = []
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.bytes_written
+
+    def write(self, b):
+        if self.closed:
+            raise ValueError('write to closed file')
+        self._buffer += b
+        self.bytes_written += len(b)
+        while len(self._buffer) >= self.part_size:
+            chunk = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit(chunk)
+        return len(b)
+
+    def _upload_part(self, part_number, chunk):
+        resp = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                       PartNumber=part_number, Body=chunk)
+        return {'ETag': resp['ETag'], 'PartNumber': part_number}
+
+    def _submit(self, chunk):
+        if self.upload_id is None:
+            resp = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.upload_id = resp['UploadId']
+        while len(self._pending) >= self.max_pending:
+            self._parts.append(self._pending.pop(0).result())
+        part_number = len(self._parts) + len(self._pending) + 1
+        self._pending.append(self._executor.submit(self._upload_part, part_number, chunk))
+
+    def close(self):
+        """
+        Uploads the remaining buffer and completes the upload; objects smaller than
+        one part skip multipart and are written with a single put
+        """
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer))
+                self._parts.extend(f.result() for f in self._pending)
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                      UploadId=self.upload_id,
+                                                      MultipartUpload={'Parts': self._parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            self._pending = []
+            self._executor.shutdown(wait=True)
+            super().close()
+
+    def abort(self):
+        """
+        Cancels the multipart upload so s3 drops the parts uploaded so far
+        """
+        for f in self._pending:
+            f.cancel()
+        self._executor.shutdown(wait=True)
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+        if not self.closed:
+            self._buffer = bytearray()
+            super().close()
+
+
+class S3PartWriter(PartFileWriter):
+    """
+    PartFileWriter that streams each part straight to s3 instead of local disk,
+    so upload overlaps the extract and no temp space is needed
+    """
+    def __init__(self, s3_client, bucket, key_prefix, delimiter='\t', gzip=True, part_rows=None,
+                 part_bytes=None, joined=False, upload_part_size=16 * 1024 * 1024, upload_concurrency=4):
+        super().__init__(key_prefix, delimiter=delimiter, gzip=gzip, part_rows=part_rows,
+                         part_bytes=part_bytes, joined=joined)
+        self.client = s3_client
+        self.bucket = bucket
+        self.upload_part_size = upload_part_size
+        self.upload_concurrency = upload_concurrency
+
+    def part_name(self, index):
+        """
+        :param index: int, zero based part number
+        :return: str, s3 key of the part
+        """
+        if not self.part_rows and not self.part_bytes:
+            return f'{self.path_prefix}/output.tsv'
+        return f'{self.path_prefix}/part-{index:05d}.tsv'
+
+    def _open_sink(self, name):
+        return S3MultipartFile(self.client, self.bucket, name, part_size=self.upload_part_size,
+                               concurrency=self.upload_concurrency)
+
+    def _abort_sink(self, sink):
+        sink.abort()
+
+    def abort(self):
+        """
+        Cancels the in-flight upload; parts already completed are left to be overwritten
+        """
+        self._discard_part()
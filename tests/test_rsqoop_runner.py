@@ -1,7 +1,11 @@
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
+import gzip
+import os
+import tempfile
 import unittest
 
 from rsqoop_runner.module import rSqoop
+from rsqoop_runner.staging import PartFileWriter, S3MultipartFile
 
 """
  You can use this test as reference on how to start using rSqoop in your code.
@@ -53,6 +57,118 @@ class TestMain(unittest.TestCase):
         print('test_get_fields', fields)
         self.assertTrue(len(fields) == 2)
 
+    @patch('rsqoop_runner.module.sleep')
+    def test_split_files(self, _sleep):
+        """
+            split_files stages one part per slice and copies with a manifest
+        """
+        self.main.sql = MagicMock()
+        self.main.sql.fetch_sql_all.side_effect = [[('Id', 'int', None, 10, 0)], [(25000,)]]
+        self.main.sql.fetch_sql.return_value = [(i,) for i in range(25000)]
+        self.main.pg_conn = MagicMock()
+        self.main.pg_conn.fetch_sql_all.side_effect = [[(2,)], [(25000,)]]
+        self.main.s3_conn = MagicMock()
+        self.main.s3_env = 'test'
+        self.main.conf = {'general': {'temp_bucket': 'test'}}
+
+        self.main.stage_to_redshift('dbo.Test', 'edw_landing.stg_test', split_files=True)
+
+        uploaded = [c[1]['key'] for c in self.main.s3_conn.put_file_to_s3.call_args_list]
+        self.assertEqual(uploaded, ['rsqoop/test/edw_landing-stg_test/part-00000.tsv',
+                                    'rsqoop/test/edw_landing-stg_test/part-00001.tsv'])
+        mfst_key = self.main.s3_conn.put_file_to_s3_from_string.call_args[0][1]
+        self.assertEqual(mfst_key, 'rsqoop/test/edw_landing-stg_test/output.manifest')
+        copy_sql = self.main.pg_conn.exec_sql.call_args_list[-2][0][0]
+        self.assertIn('output.manifest', copy_sql)
+        self.assertIn('MANIFEST', copy_sql)
+
+    def test_stream(self):
+        """
+            stream uploads straight to s3 with no temp file and no upload step
+        """
+        self.main.sql = MagicMock()
+        self.main.sql.fetch_sql_all.side_effect = [[('Id', 'int', None, 10, 0)], [(3,)]]
+        self.main.sql.fetch_sql.return_value = [(1,), (2,), (3,)]
+        self.main.pg_conn = MagicMock()
+        self.main.pg_conn.fetch_sql_all.return_value = [(3,)]
+        self.main.s3_conn = MagicMock()
+        self.main.s3_env = 'test'
+        self.main.conf = {'general': {'temp_bucket': 'test'}}
+
+        self.main.stage_to_redshift('dbo.Test', 'edw_landing.stg_test', stream=True)
+
+        self.main.s3_conn.put_file_to_s3.assert_not_called()
+        put = self.main.s3_conn.client.put_object.call_args[1]
+        self.assertEqual(put['Key'], 'rsqoop/test/edw_landing-stg_test/output.tsv')
+        self.assertEqual(len(gzip.decompress(put['Body']).splitlines()), 3)
+
+
+class TestS3MultipartFile(unittest.TestCase):
+
+    @patch.object(S3MultipartFile, 'min_part_size', 4)
+    def test_multipart(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {'UploadId': 'u1'}
+        client.upload_part.side_effect = lambda **kw: {'ETag': kw['Body'].decode()}
+        f = S3MultipartFile(client, 'bucket', 'key', part_size=4, concurrency=2)
+        f.write(b'abcdef')
+        f.write(b'ghij')
+        self.assertEqual(f.tell(), 10)
+        f.close()
+
+        parts = client.complete_multipart_upload.call_args[1]['MultipartUpload']['Parts']
+        self.assertEqual(parts, [{'ETag': 'abcd', 'PartNumber': 1}, {'ETag': 'efgh', 'PartNumber': 2},
+                                 {'ETag': 'ij', 'PartNumber': 3}])
+        client.put_object.assert_not_called()
+
+    @patch.object(S3MultipartFile, 'min_part_size', 4)
+    def test_abort_on_failed_part(self):
+        client = MagicMock()
+        client.create_multipart_upload.return_value = {'UploadId': 'u1'}
+        client.upload_part.side_effect = IOError('network')
+        f = S3MultipartFile(client, 'bucket', 'key', part_size=4)
+        f.write(b'abcdefgh')
+        with self.assertRaises(IOError):
+            f.close()
+        client.abort_multipart_upload.assert_called_once_with(Bucket='bucket', Key='key', UploadId='u1')
+        client.complete_multipart_upload.assert_not_called()
+
+
+class TestPartFileWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.prefix = os.path.join(self.tmp_dir.name, 'stg')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_part_rows(self):
+        writer = PartFileWriter(self.prefix, part_rows=4)
+        writer.writerows([[i, 'a'] for i in range(6)])
+        writer.writerow([6, 'b'])
+        writer.writerows([[i, 'c'] for i in range(7, 10)])
+        parts = writer.close()
+
+        self.assertEqual(writer.rows_written, 10)
+        self.assertEqual(len(parts), 3)
+        lines = [gzip.open(p, 'rt').read().splitlines() for p in parts]
+        self.assertEqual([len(x) for x in lines], [4, 4, 2])
+        self.assertEqual(lines[0][0], '0\ta')
+
+    def test_part_bytes(self):
+        writer = PartFileWriter(self.prefix, gzip=False, part_bytes=20000)
+        for i in range(50):
+            writer.writerow(['x' * 998])
+        parts = writer.close()
+        self.assertGreater(len(parts), 1)
+        self.assertEqual(sum(os.path.getsize(p) for p in parts), 50000)
+
+    def test_empty(self):
+        parts = PartFileWriter(self.prefix).close()
+        self.assertEqual(len(parts), 1)
+        self.assertEqual(gzip.open(parts[0], 'rt').read(), '')
+
 
 if __name__ == '__main__':
     unittest.main()